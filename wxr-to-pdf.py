@@ -53,11 +53,63 @@ deactivate
 
 import argparse
 import re
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+try:
+    from lxml import etree as ET
+    # libxml2 otherwise caps single text nodes at 10 MB, which large content:encoded blocks can exceed
+    ITERPARSE_OPTIONS = {'huge_tree': True}
+except ImportError:
+    # Fall back to the standard library, which uses the C accelerated _elementtree on CPython 3. Its
+    # TreeBuilder already joins chunked character data once per element, so it needs no extra options.
+    import xml.etree.ElementTree as ET
+    ITERPARSE_OPTIONS = {}
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
 from datetime import datetime
-import pytz
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    # Python < 3.9 has no zoneinfo; pytz's timezones work the same way with astimezone()
+    from pytz import timezone as ZoneInfo
+
+WP = '{http://wordpress.org/export/1.2/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+
+WP_AUTHOR = WP + 'author'
+WP_AUTHOR_LOGIN = WP + 'author_login'
+WP_AUTHOR_DISPLAY_NAME = WP + 'author_display_name'
+WP_BASE_BLOG_URL = WP + 'base_blog_url'
+WP_POST_TYPE = WP + 'post_type'
+WP_STATUS = WP + 'status'
+WP_COMMENT = WP + 'comment'
+WP_COMMENT_AUTHOR = WP + 'comment_author'
+WP_COMMENT_CONTENT = WP + 'comment_content'
+WP_COMMENT_DATE = WP + 'comment_date'
+WP_COMMENT_APPROVED = WP + 'comment_approved'
+DC_CREATOR = DC + 'creator'
+CONTENT_ENCODED = CONTENT + 'encoded'
+
+COMMENT_TZ = ZoneInfo('America/Los_Angeles')
+
+# WordPress caption shortcodes and the image/caption text inside them
+CAPTION_RE = re.compile(r'\[caption id="(.*?)" align="(.*?)" width="(.*?)"\](.*?)\[\/caption\]', re.DOTALL)
+CAPTION_INNER_RE = re.compile(r'(<img.*?\/>)(.*?)$', re.DOTALL)
+FACEBOOK_LIKE_RE = re.compile(r'liked this on Facebook\.')
+HTML_TAG_RE = re.compile(r'<[^<]+?>')
+
+# Dot leader between a TOC entry's title and its page number
+TOC_DOTS = '.' * 70
+
+# Used to find top-level block boundaries when handing large posts to write_html() in pieces
+HTML_TAG_SCAN_RE = re.compile(r'<(/?)([A-Za-z][A-Za-z0-9]*)[^>]*?(/?)>')
+HTML_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+HTML_BLOCK_END_TAGS = {'p', 'figure', 'div'}
+HTML_CHUNK_SIZE = 16384
+
+# Characters of post content above which preprocessing is handed to a process pool
+PARALLEL_PREPROCESS_THRESHOLD = 64 * 1024 * 1024
 
 
 class PDF(FPDF):
@@ -108,129 +160,157 @@ class PDF(FPDF):
         self.toc.append((title, page_number, link))
 
     def generate_toc(self, pdf, outline):
-        self.add_font('DejaVuSansMono', '', 'fonts/DejaVuSansMono.ttf')
         self.set_font('DejaVuSansMono', '', 12)
+        line_height = 10
+        # Entries are drawn with text() and link() instead of cell(), which redoes its layout work for every
+        # entry. The offsets place the text and its link where cell() would vertically center them.
+        x = self.l_margin + self.c_margin
+        baseline = 0.5 * line_height + 0.3 * self.font_size
+        link_top = 0.5 * line_height - 0.5 * self.font_size
         for title, page_number, link in self.toc:
-            toc_text = f'{title[:60]}'
-            self.cell(0, 10, f"{toc_text}{'.' * ((70 - len(toc_text)))}{page_number}", 0, new_x=XPos.LMARGIN,
-                      new_y=YPos.NEXT, link=link)
+            if self.will_page_break(line_height):
+                self.add_page(same=True)
+            toc_text = title[:60]
+            toc_line = f"{toc_text}{TOC_DOTS[:70 - len(toc_text)]}{page_number}"
+            self.text(x, self.y + baseline, toc_line)
+            self.link(x, self.y + link_top, self.get_string_width(toc_line), self.font_size, link)
+            self.y += line_height
+
+
+def parse_item(item, author_map, blog_tz):
+    post_type_text = item.findtext(WP_POST_TYPE)
+    status_text = item.findtext(WP_STATUS)
+    if post_type_text is None or status_text is None:
+        return None
+
+    if post_type_text not in ['post', 'page']:
+        return None
+
+    title_text = item.findtext('title', 'No Title')
+
+    if status_text != 'publish':
+        print(f"Unpublished item skipped: Title = {title_text}, Status = {status_text}")
+        return None
+
+    author_login_text = item.findtext(DC_CREATOR)
+    author_text = author_map.get(author_login_text,
+                                 'Unknown Author') if author_login_text is not None else 'Unknown Author'
+
+    pub_date = None
+    pub_date_text = item.findtext('pubDate', 'Unknown Date')
+
+    # Convert publication date to Pacific Time Zone
+    if pub_date_text != 'Unknown Date':
+        pub_date = datetime.strptime(pub_date_text, '%a, %d %b %Y %H:%M:%S %z')
+        pub_date = pub_date.astimezone(blog_tz)
+        pub_date_text = pub_date.strftime("%A, %B %-d, %Y @ %-I:%M %p")
+
+    content_text = item.findtext(CONTENT_ENCODED, '')
+
+    post_data = {
+        'title': title_text,
+        'author': author_text,
+        'pub_date': pub_date,
+        'pub_date_str': pub_date_text,
+        'byline': f'By {author_text} on {pub_date_text}',
+        'content': content_text,
+        'type': post_type_text,
+        'comments': []
+    }
+
+    for comment in item.iterfind(WP_COMMENT):
+        # Only add approved comments; skip the rest before doing any other work on them
+        comment_approved = comment.findtext(WP_COMMENT_APPROVED)
+        if comment_approved != '1':
+            continue
 
+        comment_author = comment.findtext(WP_COMMENT_AUTHOR)
+        comment_content = comment.findtext(WP_COMMENT_CONTENT)
+        comment_date = comment.findtext(WP_COMMENT_DATE)
 
-def parse_wxr(file_path, tz):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+        comment_date = datetime.fromisoformat(comment_date)
+        comment_date = comment_date.astimezone(COMMENT_TZ)
+        comment_date = comment_date.strftime("%A, %B %-d, %Y @ %-I:%M %p")
+
+        comment_data = {
+            'author': comment_author,
+            'content': comment_content,
+            'date': comment_date
+        }
+        post_data['comments'].append(comment_data)
 
-    # Extract the blog title and description
-    channel = root.find('channel')
-    blog_title = channel.find('title').text if channel.find('title') is not None else 'No Title'
-    blog_description = channel.find('description').text if channel.find('description') is not None else ''
-    url = channel.find('.//{http://wordpress.org/export/1.2/}base_blog_url').text
+    return post_data
 
-    # Extract author information
+
+def parse_wxr(file_path, tz):
+    blog_title = 'No Title'
+    blog_description = ''
+    url = None
     author_map = {}
-    for author in root.findall('.//{http://wordpress.org/export/1.2/}author'):
-        author_login = author.find('{http://wordpress.org/export/1.2/}author_login').text
-        author_display_name = author.find('{http://wordpress.org/export/1.2/}author_display_name').text
-        author_map[author_login] = author_display_name
+    blog_tz = ZoneInfo(tz)
 
     posts = []
     pages = []
-    dates = []
-
-    for item in root.findall('.//item'):
-
-        post_type = item.find('.//{http://wordpress.org/export/1.2/}post_type')
-        status = item.find('.//{http://wordpress.org/export/1.2/}status')
-        if post_type is None or status is None:
+    date_min = None
+    date_max = None
+
+    # Stream the export so only the current item is held in memory. Elements at depth 3 are the
+    # children of <channel> (rss > channel > item); this works with both lxml and xml.etree.
+    channel = None
+    depth = 0
+    for event, elem in ET.iterparse(file_path, events=('start', 'end'), **ITERPARSE_OPTIONS):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and elem.tag == 'channel':
+                channel = elem
             continue
 
-        post_type_text = post_type.text
-        status_text = status.text
-
-        if post_type_text not in ['post', 'page']:
-            continue
-
-        if status_text != 'publish':
-            print(
-                f"Unpublished item skipped: Title = {item.find('title').text if item.find('title') is not None else 'No Title'}, Status = {status_text}")
+        depth -= 1
+        if depth != 2:
             continue
 
-        title = item.find('title')
-        title_text = title.text if title is not None else 'No Title'
-
-        author_login = item.find('.//{http://purl.org/dc/elements/1.1/}creator')
-        author_text = author_map.get(author_login.text,
-                                     'Unknown Author') if author_login is not None else 'Unknown Author'
-
-        pub_date = item.find('pubDate')
-        pub_date_text = pub_date.text if pub_date is not None else 'Unknown Date'
-
-        # Convert publication date to Pacific Time Zone
-        if pub_date_text != 'Unknown Date':
-            pub_date = datetime.strptime(pub_date_text, '%a, %d %b %Y %H:%M:%S %z')
-            pub_date = pub_date.astimezone(pytz.timezone(tz))
-            dates.append(pub_date)
-
-        content = item.find('.//{http://purl.org/rss/1.0/modules/content/}encoded')
-        content_text = content.text if content is not None else ''
-
-        post_data = {
-            'title': title_text,
-            'author': author_text,
-            'pub_date': pub_date,
-            'content': content_text,
-            'type': post_type_text,
-            'comments': []
-        }
-
-        for comment in item.findall('.//{http://wordpress.org/export/1.2/}comment'):
-            comment_author = comment.find('.//{http://wordpress.org/export/1.2/}comment_author').text
-            comment_content = comment.find('.//{http://wordpress.org/export/1.2/}comment_content').text
-            comment_date = comment.find('.//{http://wordpress.org/export/1.2/}comment_date').text
-            comment_approved = comment.find('.//{http://wordpress.org/export/1.2/}comment_approved').text
-
-            comment_date = datetime.strptime(comment_date, '%Y-%m-%d %H:%M:%S')
-            comment_date = comment_date.astimezone(pytz.timezone('America/Los_Angeles'))
-            comment_date = comment_date.strftime("%A, %B %-d, %Y @ %-I:%M %p")
-
-            # Only add approved comments
-            if comment_approved == '1':
-                comment_data = {
-                    'author': comment_author,
-                    'content': comment_content,
-                    'date': comment_date
-                }
-                post_data['comments'].append(comment_data)
-
-        if post_type_text == 'post':
-            posts.append(post_data)
-        elif post_type_text == 'page':
-            pages.append(post_data)
-
-    date_range = f"{min(dates).strftime('%B %-d, %Y')} - {max(dates).strftime('%B %-d, %Y')}" if dates else 'N/A'
+        # Extract the blog title, description and author information
+        if elem.tag == 'title':
+            blog_title = elem.text
+        elif elem.tag == 'description':
+            blog_description = elem.text
+        elif elem.tag == WP_BASE_BLOG_URL:
+            url = elem.text
+        elif elem.tag == WP_AUTHOR:
+            author_login = elem.findtext(WP_AUTHOR_LOGIN)
+            author_display_name = elem.findtext(WP_AUTHOR_DISPLAY_NAME)
+            author_map[author_login] = author_display_name
+        elif elem.tag == 'item':
+            post_data = parse_item(elem, author_map, blog_tz)
+            if post_data is not None:
+                pub_date = post_data['pub_date']
+                if isinstance(pub_date, datetime):
+                    if date_min is None or pub_date < date_min:
+                        date_min = pub_date
+                    if date_max is None or pub_date > date_max:
+                        date_max = pub_date
+
+                if post_data['type'] == 'post':
+                    posts.append(post_data)
+                elif post_data['type'] == 'page':
+                    pages.append(post_data)
+
+        # Drop the parsed element so the channel doesn't accumulate the whole export
+        channel.remove(elem)
+
+    date_range = f"{date_min.strftime('%B %-d, %Y')} - {date_max.strftime('%B %-d, %Y')}" if date_min else 'N/A'
     return blog_title, blog_description, date_range, posts, pages, url
 
 
 def replace_urls(content, url):
     # TODO: Figure out how to detect and replace links to posts with PDF link to page
 
-    escaped_url = re.escape(url)
-    modified_content = re.sub(
-        fr'{escaped_url}/?wp-content/uploads/',
-        './content/',
-        content
-    )
-    # Used to see what URL for the site exist, might require manual editing
-    match = re.search(fr'{escaped_url}/?[A-Za-z0-9/-]*', modified_content)
-    if match:
-        print(f"Found URL: {match.group()}")
+    modified_content = content.replace(f'{url}/wp-content/uploads/', './content/')
+    modified_content = modified_content.replace(f'{url}wp-content/uploads/', './content/')
     return modified_content
 
 
 def replace_shortcode_captions(content):
-    # Regular expression to match WordPress caption shortcodes
-    pattern = re.compile(r'\[caption id="(.*?)" align="(.*?)" width="(.*?)"\](.*?)\[\/caption\]', re.DOTALL)
-
     # Function to convert the shortcode to HTML
     def replace_caption(match):
         id_attr = match.group(1)
@@ -239,8 +319,7 @@ def replace_shortcode_captions(content):
         inner_content = match.group(4)
 
         # Extract the image and caption text
-        inner_pattern = re.compile(r'(<img.*?\/>)(.*?)$', re.DOTALL)
-        inner_match = inner_pattern.match(inner_content.strip())
+        inner_match = CAPTION_INNER_RE.match(inner_content.strip())
 
         if inner_match:
             img_tag = inner_match.group(1).strip()
@@ -257,7 +336,7 @@ def replace_shortcode_captions(content):
             return match.group(0)  # Return the original shortcode if no match
 
     # Replace all caption shortcodes in the content
-    content = pattern.sub(replace_caption, content)
+    content = CAPTION_RE.sub(replace_caption, content)
 
     return content
 
@@ -272,10 +351,14 @@ def convert_to_paragraphs(text):
 
 
 def preprocess_content(content, url):
+    # Substring checks are much cheaper than the passes, so skip any stage that has nothing to match
+
     # Replace WordPress caption shortcodes with HTML
-    content = replace_shortcode_captions(content)
+    if '[caption' in content:
+        content = replace_shortcode_captions(content)
 
-    content = replace_urls(content, url)
+    if url in content:
+        content = replace_urls(content, url)
 
     # Convert paragraphs
     content = convert_to_paragraphs(content)
@@ -284,21 +367,65 @@ def preprocess_content(content, url):
 
 
 def preprocess_comments(comments):
-    html_comments = f'<h3>Comments ({str(len(comments))})</h3>'
-    if len(comments):
-        for comment in comments:
-            # This is specific to a plugin I had that would cross post to Facebook and slurp in comments/likes
-            if re.search(r'liked this on Facebook\.', str(comment["content"])):
-                html_comments += f'<div class="comment"><p><strong>{comment["author"]}</strong> give this a <strong>LIKE</strong> on Facebook!</p></div>'
-            else:
-                html_comments += f'<div class="comment"><p><strong>{comment["author"]}</strong> on {comment["date"]}:</p>'
-                html_comments += f'<p>{re.sub("<[^<]+?>", "", str(comment["content"]))}</p></div>'
-        return html_comments
-    else:
+    if not comments:
         return ""
 
+    # Collect the pieces and join once rather than growing a string per comment
+    html_comments = [f'<h3>Comments ({len(comments)})</h3>']
+    for comment in comments:
+        content = comment["content"] or ''
+        # This is specific to a plugin I had that would cross post to Facebook and slurp in comments/likes
+        if FACEBOOK_LIKE_RE.search(content):
+            html_comments.append(f'<div class="comment"><p><strong>{comment["author"]}</strong> give this a <strong>LIKE</strong> on Facebook!</p></div>')
+        else:
+            html_comments.append(f'<div class="comment"><p><strong>{comment["author"]}</strong> on {comment["date"]}:</p>')
+            html_comments.append(f'<p>{HTML_TAG_RE.sub("", content)}</p></div>')
+    return ''.join(html_comments)
+
+
+def prepare_html(item, url, site_url_re=None):
+    # Kept at module level so ProcessPoolExecutor can pickle it
+    content = preprocess_content(item['content'], url)
+
+    # Used to see what URL for the site exist, might require manual editing (only with --verbose)
+    site_url = None
+    if site_url_re is not None:
+        match = site_url_re.search(content)
+        if match:
+            site_url = match.group()
+
+    return content + preprocess_comments(item['comments']), site_url
+
+
+def split_html_blocks(html, chunk_size=HTML_CHUNK_SIZE):
+    # Split after top-level </p>, </figure> and </div> tags into pieces of at least chunk_size characters,
+    # so write_html() never has to build the tree for a whole large post at once
+    if len(html) <= chunk_size:
+        return [html]
+
+    chunks = []
+    start = 0
+    depth = 0
+    for match in HTML_TAG_SCAN_RE.finditer(html):
+        closing, tag, self_closing = match.groups()
+        tag = tag.lower()
+        if self_closing or tag in HTML_VOID_TAGS:
+            continue
+        if not closing:
+            depth += 1
+            continue
+
+        depth = max(depth - 1, 0)
+        if depth == 0 and tag in HTML_BLOCK_END_TAGS and match.end() - start >= chunk_size:
+            chunks.append(html[start:match.end()])
+            start = match.end()
+
+    if start < len(html):
+        chunks.append(html[start:])
+    return chunks
+
 
-def create_pdf(blog_title, blog_description, date_range, posts, pages, url, output_path):
+def create_pdf(blog_title, blog_description, date_range, posts, pages, url, output_path, verbose=False):
     pdf = PDF(blog_title, blog_description, date_range, url)
     pdf.set_auto_page_break(auto=True, margin=15)
 
@@ -307,6 +434,7 @@ def create_pdf(blog_title, blog_description, date_range, posts, pages, url, outp
     pdf.add_font('DejaVu', 'B', 'fonts/DejaVuSans-Bold.ttf')
     pdf.add_font('DejaVu', 'I', 'fonts/DejaVuSans-Oblique.ttf')
     pdf.add_font('DejaVu', 'BI', 'fonts/DejaVuSans-BoldOblique.ttf')
+    pdf.add_font('DejaVuSansMono', '', 'fonts/DejaVuSansMono.ttf')
 
     # Add title page
     pdf.add_title_page()
@@ -327,14 +455,27 @@ def create_pdf(blog_title, blog_description, date_range, posts, pages, url, outp
     # pdf.set_font('DejaVu', '', 12)
     # pdf.cell(0, 10, "These are posts (separate from blog pages) on the site.", 0, align='C')
 
-    def add_content(items, item_type="post"):
-        for item in items:
+    site_url_re = re.compile(fr'{re.escape(url)}/?[A-Za-z0-9/-]*') if verbose else None
+
+    # Preprocessing each post is independent, but it only pays to spread it across cores for very large exports:
+    # starting the workers and pickling every post out and its HTML back costs more than the work itself below that
+    prepare = partial(prepare_html, url=url, site_url_re=site_url_re)
+    if sum(len(item['content']) for item in posts + pages) >= PARALLEL_PREPROCESS_THRESHOLD:
+        with ProcessPoolExecutor() as pool:
+            posts_html = list(pool.map(prepare, posts, chunksize=16))
+            pages_html = list(pool.map(prepare, pages, chunksize=16))
+    else:
+        posts_html = list(map(prepare, posts))
+        pages_html = list(map(prepare, pages))
+
+    # Report each URL once at the end rather than printing from every post
+    if verbose:
+        for site_url in sorted({site_url for _, site_url in posts_html + pages_html if site_url}):
+            print(f"Found URL: {site_url}")
+
+    def add_content(items, items_html, item_type="post"):
+        for item, (full_content, _) in zip(items, items_html):
             title = item['title']
-            author = item['author']
-            pub_date = item['pub_date']
-            content = preprocess_content(item['content'], url)
-            comments_html = preprocess_comments(item['comments'])
-            full_content = content + comments_html
 
             pdf.add_page()
             page_number = pdf.page_no()
@@ -348,20 +489,20 @@ def create_pdf(blog_title, blog_description, date_range, posts, pages, url, outp
             pdf.cell(0, 10, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, link=link)
 
             pdf.set_font('DejaVu', 'I', 12)
-            pdf.cell(0, 10, f'By {author} on {pub_date.strftime("%A, %B %-d, %Y @ %-I:%M %p")}', 0, new_x=XPos.LMARGIN,
-                     new_y=YPos.NEXT)
+            pdf.cell(0, 10, item['byline'], 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
             pdf.ln(5)
 
             pdf.set_font('DejaVu', '', 12)
-            pdf.write_html(full_content,
-                           ul_bullet_char="•",
-                           li_prefix_color="#000000",
-                           tag_indents={"blockquote": 20},
-                           )
+            for html_chunk in split_html_blocks(full_content):
+                pdf.write_html(html_chunk,
+                               ul_bullet_char="•",
+                               li_prefix_color="#000000",
+                               tag_indents={"blockquote": 20},
+                               )
             pdf.ln(10)
 
     # Add posts first
-    add_content(posts)
+    add_content(posts, posts_html)
 
     pdf.add_page()
     # Uncomment the following if the "Pages" page should be included in the TOC
@@ -375,7 +516,7 @@ def create_pdf(blog_title, blog_description, date_range, posts, pages, url, outp
     pdf.cell(0, 10, "These are pages (separate from blog posts) on the site.", 0, align='C')
 
     # Add pages at the end
-    add_content(pages, item_type="page")
+    add_content(pages, pages_html, item_type="page")
 
     pdf.output(output_path)
 
@@ -387,15 +528,18 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_pdf', type=str, help='Path to the output PDF file')
     parser.add_argument('-tz', '--timezone', type=str, help='Timezone of blog, e.g. "America/Los_Angeles"',
                         default="America/Los_Angeles", required=False)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print site URLs still found in content, which might require manual editing')
 
     # Parse arguments
     args = parser.parse_args()
     wxr_file = args.wxr_file
     output_pdf = args.output_pdf
     tz = args.timezone
+    verbose = args.verbose
 
     # Process WXR file and create PDF
     blog_title, blog_description, date_range, posts, pages, url = parse_wxr(wxr_file, tz)
 
-    create_pdf(blog_title, blog_description, date_range, posts, pages, url, output_pdf)
+    create_pdf(blog_title, blog_description, date_range, posts, pages, url, output_pdf, verbose)
     print(f'PDF created: {output_pdf}')